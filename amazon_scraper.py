@@ -1,10 +1,15 @@
 import os
+import time
+import shelve
 import asyncio
 import json
+import orjson
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import re
+from html import unescape
 from dotenv import load_dotenv
+from jsonl_output import stream_to_jsonl, jsonl_to_json
 from crawl4ai import (
     AsyncWebCrawler,
     BrowserConfig,
@@ -18,6 +23,14 @@ from crawl4ai import (
 TARGET_URL = "https://www.amazon.in/"
 SEARCH_TERM = "Biscuits"
 
+# Product URLs that recently failed are remembered here and not re-fetched until the TTL expires
+STATUS_CACHE_FILE = "amazon_status_cache"
+NOT_FOUND_TTL = 24 * 60 * 60  # 404s: one day
+SERVER_ERROR_TTL = 10 * 60  # 5xx: ten minutes
+
+# Attempts per product page when Amazon throttles with 503
+FETCH_RETRIES = 3
+
 # Load Gemini API Key (set in .env or directly here)
 load_dotenv()
 os.environ["GEMINI_API_KEY"] = os.getenv("GEMINI_API_KEY")
@@ -40,13 +53,147 @@ gemini_schema = {
     },
 }
 
-async def get_amazon_product_details(session, product_url):
+# Strainers limiting the product page parse to the nodes we actually read
+SCRIPT_STRAINER = SoupStrainer('script', type='text/javascript')
+SECTION_STRAINER = SoupStrainer(id=['imgTagWrapperId', 'corePriceDisplay_desktop_feature_div', 'productDetails_detailBullets_sections1'])
+IMAGE_STRAINER = SoupStrainer(class_=['imgTagWrapper', 'a-dynamic-image'])
+
+# Byte patterns for the regex fast path over the raw product page
+MRP_RE = re.compile(rb'<span class="a-price a-text-price"[^>]*>\s*<span class="a-offscreen">([^<]+)</span>')
+DETAILS_ROW_RE = re.compile(rb'<tr[^>]*>\s*<th[^>]*>([^<]+)</th>\s*<td[^>]*>([^<]+)</td>', re.DOTALL)
+DYNAMIC_IMG_RE = re.compile(rb'<img\b[^>]*\bclass="[^"]*\ba-dynamic-image\b[^"]*"[^>]*>')
+IMG_SRC_RE = re.compile(rb'\bsrc="([^"]+)"')
+DETAILS_TABLE_MARKER = b'id="productDetails_detailBullets_sections1"'
+PRICE_BLOCK_MARKER = b'id="corePriceDisplay_desktop_feature_div"'
+
+# Header text of the details table rows record_detail_row keeps, by the scraped_results field they fill
+DETAIL_ROW_HEADERS = {
+    'item_weight': b'Item Weight',
+    'manufacturer_address': b'Manufacturer',
+    'packer_address': b'Packer',
+    'mrp': b'MRP',
+}
+TAG_NAME_RE = re.compile(rb'<([A-Za-z][A-Za-z0-9]*)')
+
+# Decoder and fallback patterns for pulling the 'colorImages' JSON out of the page scripts
+JSON_DECODER = json.JSONDecoder()
+COLOR_IMAGES_RE = re.compile(r"'colorImages':\s*({.*?})\s*,\s*'colorToAsin'", re.DOTALL)
+TRAILING_COMMA_OBJ_RE = re.compile(r',\s*}')
+TRAILING_COMMA_ARR_RE = re.compile(r',\s*\]')
+
+def decode_html_text(raw):
+    """
+    Decodes a raw HTML text fragment matched by the fast-path regexes.
+    
+    :param raw: bytes - The matched fragment.
+    :return: str - Unescaped text with surrounding whitespace and direction marks removed.
+    """
+    return unescape(raw.decode('utf-8', 'replace')).strip().replace('\u200f', '').replace('\u200e', '')
+
+def find_element_end(html, marker_pos):
+    """
+    Finds where the element whose opening tag contains marker_pos ends, by balancing its tag name.
+    
+    :param html: bytes - The raw page.
+    :param marker_pos: int - Offset of an attribute inside the element's opening tag.
+    :return: int - Offset just past the element's closing tag, or -1 if it is not closed within html.
+    """
+    tag_start = html.rfind(b'<', 0, marker_pos)
+    name_match = TAG_NAME_RE.match(html, tag_start) if tag_start >= 0 else None
+    if not name_match:
+        return -1
+    tag_re = re.compile(rb'<(/?)' + name_match.group(1) + rb'\b')
+    depth = 0
+    for tag_match in tag_re.finditer(html, tag_start):
+        depth += -1 if tag_match.group(1) else 1
+        if depth == 0:
+            tag_close = html.find(b'>', tag_match.end())
+            return tag_close + 1 if tag_close >= 0 else -1
+    return -1
+
+async def read_product_page(response):
+    """
+    Streams a product page body, keeping it only up to the end of the product details table.
+    
+    Everything the scraper reads sits before the end of that table, so the rest of the page
+    (reviews, recommendation carousels, footer) is drained without being held in memory or
+    scanned. Draining instead of stopping early lets the keep-alive connection go back to the pool.
+    
+    :param response: aiohttp.ClientResponse - The product page response.
+    :return: bytes - The page body up to the end of the details table (the whole page if it has none).
+    """
+    body = bytearray()
+    table_start = -1
+    table_closed = False
+    async for chunk in response.content.iter_chunked(1 << 16):
+        if table_closed:
+            continue
+        previous_length = len(body)
+        body += chunk
+        if table_start < 0:
+            table_start = body.find(DETAILS_TABLE_MARKER, max(0, previous_length - len(DETAILS_TABLE_MARKER)))
+        if table_start >= 0 and body.find(b'</table>', max(table_start, previous_length - len(b'</table>'))) >= 0:
+            table_closed = True
+    return bytes(body)
+
+def parse_color_images(script_text):
+    """
+    Decodes the 'colorImages' object embedded in a product page script.
+    
+    The object is decoded in place with JSONDecoder.raw_decode, which stops at its closing
+    brace. Scripts with trailing commas fall back to cutting the object out by regex and
+    stripping the commas first.
+    
+    :param script_text: str - The script tag contents.
+    :return: dict - The decoded object, or None if it is missing or malformed.
+    """
+    start = script_text.find("'colorImages':")
+    brace = script_text.find('{', start) if start >= 0 else -1
+    if brace < 0:
+        return None
+    try:
+        data, _ = JSON_DECODER.raw_decode(script_text[brace:].replace("'", '"'))
+        return data
+    except json.JSONDecodeError:
+        pass
+    
+    match = COLOR_IMAGES_RE.search(script_text)
+    if not match:
+        return None
+    try:
+        json_str = match.group(1).replace("'", '"')
+        json_str = TRAILING_COMMA_OBJ_RE.sub('}', json_str)
+        json_str = TRAILING_COMMA_ARR_RE.sub(']', json_str)
+        return orjson.loads(json_str)
+    except json.JSONDecodeError as e:
+        print(f"Error parsing JSON: {e}")
+        return None
+
+def record_detail_row(scraped_results, key, value):
+    """
+    Stores a product details table row in scraped_results if it is one of the tracked fields.
+    
+    :param scraped_results: dict - The scraped results being filled in.
+    :param key: str - The row header.
+    :param value: str - The row value.
+    """
+    if 'Item Weight' in key:
+        scraped_results['item_weight'] = value
+    elif 'Manufacturer' in key:
+        scraped_results['manufacturer_address'] = value
+    elif 'Packer' in key:
+        scraped_results['packer_address'] = value
+    if 'MRP' in key and scraped_results['mrp'] == "non_stated":
+        scraped_results['mrp'] = value
+
+async def get_amazon_product_details(session, product_url, status_cache=None):
     """
     Extracts all high-resolution product image URLs and additional scraped results (MRP, manufacturer address, packer address, item weight)
     from an Amazon product page. If any parameter is not found, it is set to "non_stated".
     
     :param session: aiohttp.ClientSession - The async HTTP session.
     :param product_url: str - The URL of the Amazon product page.
+    :param status_cache: shelve.Shelf - Optional cache of (status, fetched_at) per URL used to skip recently failed pages.
     :return: dict - A dictionary with 'images' (list of str) and 'scraped_results' (dict).
     """
     # Set headers to mimic a browser request and avoid bot detection
@@ -57,61 +204,89 @@ async def get_amazon_product_details(session, product_url):
         'Referer': 'https://www.amazon.in/',
     }
     
-    try:
-        async with session.get(product_url, headers=headers, timeout=10) as response:
-            response.raise_for_status()
-            html = await response.text()
-    except Exception as e:
-        print(f"Error fetching the page: {e}")
-        return {"images": [], "scraped_results": {}}
+    # Skip pages that returned 404 or 5xx within their TTL
+    if status_cache is not None and product_url in status_cache:
+        status, fetched_at = status_cache[product_url]
+        ttl = NOT_FOUND_TTL if status == 404 else SERVER_ERROR_TTL if status >= 500 else 0
+        if time.time() - fetched_at < ttl:
+            print(f"Skipping recently failed page ({status}): {product_url}")
+            return {"images": [], "scraped_results": {}}
     
-    # Parse the HTML content
-    soup = BeautifulSoup(html, 'html.parser')
+    html = None
+    for attempt in range(FETCH_RETRIES):
+        try:
+            async with session.get(product_url, headers=headers, timeout=10) as response:
+                if status_cache is not None:
+                    status_cache[product_url] = (response.status, time.time())
+                if response.status != 503 or attempt == FETCH_RETRIES - 1:
+                    response.raise_for_status()
+                    # Keep the raw bytes; the regex fast path and lxml both work without a decode
+                    html = await read_product_page(response)
+        except Exception as e:
+            print(f"Error fetching the page: {e}")
+            return {"images": [], "scraped_results": {}}
+        if html is not None:
+            break
+        
+        # Back off exponentially on 503 (throttling) before retrying
+        wait_time = 2 ** attempt
+        print(f"Got 503 for {product_url}, retrying after {wait_time}s (attempt {attempt + 1}/{FETCH_RETRIES})")
+        await asyncio.sleep(wait_time)
+    
+    # Parsed lazily, only when a regex fast path comes up empty
+    section_soup = None
     
-    # Initialize list to store image URLs
+    # Initialize list to store image URLs, with a set for O(1) duplicate checks
     image_urls = []
+    seen_urls = set()
     
     # Attempt 1: Extract images from 'colorImages' JSON in script tags
-    for script in soup.find_all('script', type='text/javascript'):
+    script_soup = BeautifulSoup(html, 'lxml', parse_only=SCRIPT_STRAINER)
+    for script in script_soup.find_all('script', type='text/javascript'):
         if script.string and 'colorImages' in script.string:
-            match = re.search(r"'colorImages':\s*({.*?})\s*,\s*'colorToAsin'", script.string, re.DOTALL)
-            if match:
-                json_str = match.group(1)
-                try:
-                    json_str = json_str.replace("'", '"')
-                    json_str = re.sub(r',\s*}', '}', json_str)
-                    json_str = re.sub(r',\s*\]', ']', json_str)
-                    data = json.loads(json_str)
-                    initial_images = data.get('initial', [])
-                    for img_data in initial_images:
-                        hi_res = img_data.get('hiRes')
-                        large = img_data.get('large')
-                        if hi_res and hi_res not in image_urls:
-                            image_urls.append(hi_res)
-                        elif large and large not in image_urls:
-                            image_urls.append(large)
-                except json.JSONDecodeError as e:
-                    print(f"Error parsing JSON: {e}")
-    
-    # Attempt 2: Fallback to DOM-based image extraction if JSON parsing fails
+            data = parse_color_images(script.string)
+            if data:
+                initial_images = data.get('initial', [])
+                for img_data in initial_images:
+                    hi_res = img_data.get('hiRes')
+                    large = img_data.get('large')
+                    if hi_res and hi_res not in seen_urls:
+                        seen_urls.add(hi_res)
+                        image_urls.append(hi_res)
+                    elif large and large not in seen_urls:
+                        seen_urls.add(large)
+                        image_urls.append(large)
+    
+    # Attempt 2: Match 'a-dynamic-image' tags straight from the raw page
     if not image_urls:
-        image_block = soup.find('div', id='imgTagWrapperId') or soup.find('div', class_='imgTagWrapper')
+        for img_match in DYNAMIC_IMG_RE.finditer(html):
+            src_match = IMG_SRC_RE.search(img_match.group(0))
+            if src_match:
+                src = decode_html_text(src_match.group(1))
+                if src not in seen_urls:
+                    seen_urls.add(src)
+                    image_urls.append(src)
+    
+    # Attempt 3: Fallback to DOM-based image extraction if both fast paths fail
+    if not image_urls:
+        section_soup = BeautifulSoup(html, 'lxml', parse_only=SECTION_STRAINER)
+        image_soup = BeautifulSoup(html, 'lxml', parse_only=IMAGE_STRAINER)
+        image_block = section_soup.find('div', id='imgTagWrapperId') or image_soup.find('div', class_='imgTagWrapper')
         if image_block:
             img_tag = image_block.find('img')
             if img_tag and 'src' in img_tag.attrs:
+                seen_urls.add(img_tag['src'])
                 image_urls.append(img_tag['src'])
         
-        alt_images = soup.find_all('img', class_='a-dynamic-image')
+        alt_images = image_soup.find_all('img', class_='a-dynamic-image')
         for img in alt_images:
-            if 'src' in img.attrs and img['src'] not in image_urls:
+            if 'src' in img.attrs and img['src'] not in seen_urls:
+                seen_urls.add(img['src'])
                 image_urls.append(img['src'])
     
-    # Filter out invalid or non-image URLs
+    # Filter out invalid or non-image URLs (already unique)
     image_urls = [url for url in image_urls if url and url.startswith('https') and (url.endswith('.jpg') or url.endswith('.png'))]
     
-    # Remove duplicates
-    image_urls = list(dict.fromkeys(image_urls))
-    
     # Extract additional scraped results from product details section
     scraped_results = {
         "mrp": "non_stated",
@@ -120,32 +295,54 @@ async def get_amazon_product_details(session, product_url):
         "item_weight": "non_stated"
     }
     
-    # Extract MRP from price block (often shown as M.R.P.)
-    price_block = soup.find('div', id='corePriceDisplay_desktop_feature_div')
-    if price_block:
-        mrp_span = price_block.find('span', class_='a-price a-text-price')
-        if mrp_span:
-            mrp_value = mrp_span.find('span', class_='a-offscreen')
-            if mrp_value:
-                scraped_results['mrp'] = mrp_value.text.strip()
-    
-    # Extract details from the product details table
-    details_table = soup.find('table', id='productDetails_detailBullets_sections1')
-    if details_table:
-        for tr in details_table.find_all('tr'):
-            th = tr.find('th')
-            td = tr.find('td')
-            if th and td:
-                key = th.text.strip().replace('\u200f', '').replace('\u200e', '')
-                value = td.text.strip().replace('\u200f', '').replace('\u200e', '')
-                if 'Item Weight' in key:
-                    scraped_results['item_weight'] = value
-                elif 'Manufacturer' in key:
-                    scraped_results['manufacturer_address'] = value
-                elif 'Packer' in key:
-                    scraped_results['packer_address'] = value
-                if 'MRP' in key and scraped_results['mrp'] == "non_stated":
-                    scraped_results['mrp'] = value
+    # Extract MRP from price block (often shown as M.R.P.), first with a regex scan bounded to the block
+    # so a struck-through price further down the page (e.g. a recommendation carousel) is never picked up
+    price_start = html.find(PRICE_BLOCK_MARKER)
+    if price_start >= 0:
+        price_end = find_element_end(html, price_start)
+        mrp_match = MRP_RE.search(html, price_start, price_end) if price_end >= 0 else None
+        if mrp_match:
+            scraped_results['mrp'] = decode_html_text(mrp_match.group(1))
+    
+    # Extract details from the product details table, first with a regex scan bounded to the table
+    missed_detail_rows = False
+    table_start = html.find(DETAILS_TABLE_MARKER)
+    if table_start >= 0:
+        table_end = html.find(b'</table>', table_start)
+        if table_end < 0:
+            table_end = len(html)
+        for key, value in DETAILS_ROW_RE.findall(html, table_start, table_end):
+            record_detail_row(scraped_results, decode_html_text(key), decode_html_text(value))
+        # The regex skips rows with nested markup; a tracked header still unfilled means one was missed
+        missed_detail_rows = any(
+            scraped_results[field] == "non_stated" and html.find(header, table_start, table_end) >= 0
+            for field, header in DETAIL_ROW_HEADERS.items()
+        )
+    
+    # Fall back to the strained DOM for whatever the regexes missed
+    if (price_start >= 0 and scraped_results['mrp'] == "non_stated") or missed_detail_rows:
+        if section_soup is None:
+            section_soup = BeautifulSoup(html, 'lxml', parse_only=SECTION_STRAINER)
+        
+        if scraped_results['mrp'] == "non_stated":
+            price_block = section_soup.find('div', id='corePriceDisplay_desktop_feature_div')
+            if price_block:
+                mrp_span = price_block.find('span', class_='a-price a-text-price')
+                if mrp_span:
+                    mrp_value = mrp_span.find('span', class_='a-offscreen')
+                    if mrp_value:
+                        scraped_results['mrp'] = mrp_value.text.strip()
+        
+        if missed_detail_rows:
+            details_table = section_soup.find('table', id='productDetails_detailBullets_sections1')
+            if details_table:
+                for tr in details_table.find_all('tr'):
+                    th = tr.find('th')
+                    td = tr.find('td')
+                    if th and td:
+                        key = th.text.strip().replace('\u200f', '').replace('\u200e', '')
+                        value = td.text.strip().replace('\u200f', '').replace('\u200e', '')
+                        record_detail_row(scraped_results, key, value)
     
     return {"images": image_urls, "scraped_results": scraped_results}
 
@@ -193,7 +390,7 @@ async def extract_products_with_gemini():
             print("❌ No search results extracted. Exiting.")
             return
 
-        products = json.loads(search_result.extracted_content)
+        products = orjson.loads(search_result.extracted_content)
         print(f"✅ Extracted details for {len(products)} products from the search results.")
 
         # Normalize URLs
@@ -201,36 +398,43 @@ async def extract_products_with_gemini():
             if product.get("product_url", "").startswith("/"):
                 product["product_url"] = "https://www.amazon.in" + product["product_url"]
 
-        # Step 2: Fetch all images and scraped results concurrently
-        all_data = []
-        sem = asyncio.Semaphore(5)  # Limit to 5 concurrent requests to avoid rate limiting
-        async with aiohttp.ClientSession() as session:
-            async def fetch_with_sem(url, product_name):
-                print(f"  ➡️ Processing images for product: {product_name}...")
-                async with sem:
-                    if url:
-                        return await get_amazon_product_details(session, url)
-                    return {"images": [], "scraped_results": {}}
-
-            tasks = [fetch_with_sem(product.get("product_url", ""), product.get("product_name", "N/A")) for product in products[:32]]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            for product, result in zip(products[:32], results):
-                if not isinstance(result, Exception):
-                    product["all_images"] = result["images"]
-                    product["scraped_results"] = result["scraped_results"]
-                    print(f"  ✅ Extracted {len(product['all_images'])} images for '{product['product_name']}'.")
-                else:
-                    product["all_images"] = []
-                    product["scraped_results"] = {}
-                    print(f"  ❌ Failed to extract images for '{product.get('product_name', 'N/A')}'. Error: {result}")
-                all_data.append(product)
-
-        # Save to file
+        # Step 2: Fetch all images and scraped results concurrently, streaming products to disk in search-result order
+        jsonl_file = "amazon_products_with_all_images.jsonl"
+
+        async def fetch_all(write_queue):
+            # The connector caps concurrent connections per host (rate limiting), caches DNS and keeps connections alive
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=60)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                with shelve.open(STATUS_CACHE_FILE) as status_cache:
+                    async def fetch_details(product):
+                        url = product.get("product_url", "")
+                        print(f"  ➡️ Processing images for product: {product.get('product_name', 'N/A')}...")
+                        try:
+                            result = await get_amazon_product_details(session, url, status_cache) if url else {"images": [], "scraped_results": {}}
+                            product["all_images"] = result["images"]
+                            product["scraped_results"] = result["scraped_results"]
+                            print(f"  ✅ Extracted {len(product['all_images'])} images for '{product['product_name']}'.")
+                        except Exception as e:
+                            product["all_images"] = []
+                            product["scraped_results"] = {}
+                            print(f"  ❌ Failed to extract images for '{product.get('product_name', 'N/A')}'. Error: {e}")
+                        return product
+
+                    # Each product is written once it and every product before it are done
+                    fetches = [asyncio.create_task(fetch_details(product)) for product in products[:32]]
+                    try:
+                        for fetch in fetches:
+                            await write_queue.put(await fetch)
+                    finally:
+                        for fetch in fetches:
+                            fetch.cancel()
+
+        await stream_to_jsonl(fetch_all, jsonl_file)
+
+        # Merge into the JSON array read by the OCR step
         output_file = "amazon_products_with_all_images.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(all_data, f, indent=2)
-        print(f"🎉 Saved all product data to '{output_file}'.")
+        count = jsonl_to_json(jsonl_file, output_file)
+        print(f"🎉 Saved {count} products to '{output_file}'.")
 
 if __name__ == "__main__":
     asyncio.run(extract_products_with_gemini())
\ No newline at end of file
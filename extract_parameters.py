@@ -1,11 +1,15 @@
-import json
+import re
+import orjson
+import shelve
+import hashlib
 import logging
 import asyncio
-from typing import List, Dict, Any
-from google.generativeai import GenerativeModel, configure
-import google.generativeai as genai
+from typing import List, Dict, Any, Optional
+from google import genai
+from google.genai import types
 import os
 from dotenv import load_dotenv
+from jsonl_output import stream_to_jsonl, jsonl_to_json
 
 load_dotenv()
 
@@ -13,141 +17,219 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Semaphore for Gemini API rate-limiting
-api_semaphore = asyncio.Semaphore(1)
+# Extracted parameters keyed by a hash of the normalized OCR text, so repeated labels skip Gemini
+PARAMETER_CACHE_FILE = "gemini_compliance_cache"
 
-async def extract_compliance_parameters(products: List[Dict], api_keys: List[str]) -> List[Dict]:
+# Kept identical across requests so Gemini can reuse the cached prompt prefix
+SYSTEM_PROMPT = """You are an expert in India's Legal Metrology (Packaged Commodities) Rules, 2011. You will be given the text of several numbered products. For each product, extract only the following parameters from its text:
+1. Manufacturer Name (or Packer/Importer Name if Manufacturer Name is not present)
+2. Manufacturer Address (or Packer/Importer Address if Manufacturer Address is not present)
+3. Net Quantity (include unit, e.g., 500g, 1L)
+4. Consumer Care Details (address, phone number, email) included in the single consumer details key
+5. Country of Origin (Determined based on the Address)
+6. State (only if Country of Origin is India, determined from address; otherwise "non_stated")
+
+Rules:
+- If a parameter is not found, set its value to "non_stated".
+- if multiple values are found for a parameter, choose only one the most relevant one based on context.
+- Extract exact values; do not summarize or modify (e.g., do not state "SAME AS MARKETED BY").
+- Do not extract irrelevant metadata or nutritional values.
+- Do not extract a parameter multiple times.
+- For State, extract only if an Indian address is present; use address to infer the state if explicit state is missing.
+- Never mix text between products.
+
+For each parameter, extract:
+- name: parameter name (e.g., manufacturer_name, net_quantity)
+- value: parameter value (e.g., ABC Corp, 500g)
+- context: category it belongs to (e.g., Manufacturing Details, Product Information, Consumer Care, Country of Origin)
+
+Return ONLY a JSON array with one element per product, in product order. Each element is the JSON array of parameter objects for that product:
+[
+    [
+        {
+            "name": string,
+            "value": string,
+            "context": string
+        }
+    ]
+]
+Do not include any other text or explanation outside the JSON array."""
+
+def non_stated_parameters() -> List[Dict]:
+    """
+    Build the parameter list used when nothing could be extracted for a product.
+    
+    Returns:
+        Fresh list of parameter objects with every value set to "non_stated"
+    """
+    return [
+        {"name": "manufacturer_name", "value": "non_stated", "context": "Manufacturing Details"},
+        {"name": "manufacturer_address", "value": "non_stated", "context": "Manufacturing Details"},
+        {"name": "net_quantity", "value": "non_stated", "context": "Product Information"},
+        {"name": "consumer_care_address", "value": "non_stated", "context": "Consumer Care"},
+        {"name": "consumer_care_phone", "value": "non_stated", "context": "Consumer Care"},
+        {"name": "consumer_care_email", "value": "non_stated", "context": "Consumer Care"},
+        {"name": "country_of_origin", "value": "non_stated", "context": "Country of Origin"},
+        {"name": "state", "value": "non_stated", "context": "Country of Origin"}
+    ]
+
+def ocr_cache_key(ocr_text: str) -> str:
+    """
+    Hash OCR text into a parameter cache key, ignoring case and whitespace differences.
+    
+    Args:
+        ocr_text: Aggregated OCR text of a product
+    Returns:
+        Hex digest used as the cache key
+    """
+    normalized = re.sub(r"\s+", " ", ocr_text).strip().lower()
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+def validate_parameters(parameters: Any) -> None:
+    """
+    Check that a product's extracted parameters have the expected structure.
+    
+    Args:
+        parameters: Parsed parameter list for one product
+    Raises:
+        ValueError: If the structure is invalid
+    """
+    if not isinstance(parameters, list):
+        raise ValueError("Response is not a JSON array")
+    for param in parameters:
+        if not isinstance(param, dict):
+            raise ValueError("Parameter is not a JSON object")
+        if not all(key in param for key in ["name", "value", "context"]):
+            raise ValueError("Parameter missing required fields")
+        if not all(isinstance(param[key], str) for key in ["name", "value", "context"]):
+            raise ValueError("Parameter fields must be strings")
+
+async def extract_compliance_parameters(products: List[Dict], api_keys: List[str], output_queue: Optional[asyncio.Queue] = None) -> List[Dict]:
     """
     Extract compliance parameters from cleaned OCR results using Gemini LLM with multiple API keys.
     
+    Products are sent to Gemini in batches, one request per batch.
+    
     Args:
         products: List of product dictionaries with cleaned ocr_results
         api_keys: List of Gemini API keys for fallback
+        output_queue: Optional queue receiving each product as soon as its batch is done, instead of collecting them
     Returns:
-        List of product dictionaries with added compliance_parameters
+        List of product dictionaries with added compliance_parameters (empty when streaming to output_queue)
     """
-    async def process_product(product: Dict) -> Dict:
-        logger.info(f"Processing product: {product.get('product_name', 'Unknown')}")
-        product_info = {**product}  # Copy existing keys
-        ocr_text = " ".join(product.get("ocr_results", []))  # Aggregate OCR results
-        
-        if not ocr_text:
-            logger.warning(f"No OCR results for product {product.get('product_id')}")
-            product_info["compliance_parameters"] = [
-                {"name": "manufacturer_name", "value": "non_stated", "context": "Manufacturing Details"},
-                {"name": "manufacturer_address", "value": "non_stated", "context": "Manufacturing Details"},
-                {"name": "net_quantity", "value": "non_stated", "context": "Product Information"},
-                {"name": "consumer_care_address", "value": "non_stated", "context": "Consumer Care"},
-                {"name": "consumer_care_phone", "value": "non_stated", "context": "Consumer Care"},
-                {"name": "consumer_care_email", "value": "non_stated", "context": "Consumer Care"},
-                {"name": "country_of_origin", "value": "non_stated", "context": "Country of Origin"},
-                {"name": "state", "value": "non_stated", "context": "Country of Origin"}
-            ]
-            return product_info
+    # One client per API key, built once and reused by every batch; configure() was process-global
+    # and rebuilding the model on each attempt threw away its connection pool
+    api_keys = [api_key for api_key in api_keys if api_key]
+    clients = [genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=60_000)) for api_key in api_keys]
+    
+    async def request_parameters(pending: List[Dict]) -> List[Optional[List[Dict]]]:
+        # One Gemini request for the given products, trying each key until the reply has one entry
+        # per product; entries that fail validation come back as None, as do all of them if every key fails
+        prompt = f"Extract compliance parameters for each of these {len(pending)} products:\n\n"
+        for number, product in enumerate(pending, 1):
+            prompt += f"Product {number}:\n{' '.join(product['ocr_results'])}\n\n"
+        prompt += f"Return ONLY a valid JSON array of exactly {len(pending)} parameter arrays, one per product in order."
         
-        async with api_semaphore:
-            for api_key_index, api_key in enumerate(api_keys):
-                try:
-                    configure(api_key=api_key)
-                    model = GenerativeModel('gemini-2.0-flash')
-                    
-                    system_prompt = """You are an expert in India's Legal Metrology (Packaged Commodities) Rules, 2011. Extract only the following parameters from the provided text:
-                    1. Manufacturer Name (or Packer/Importer Name if Manufacturer Name is not present)
-                    2. Manufacturer Address (or Packer/Importer Address if Manufacturer Address is not present)
-                    3. Net Quantity (include unit, e.g., 500g, 1L)
-                    4. Consumer Care Details (address, phone number, email) included in the single consumer details key
-                    5. Country of Origin (Determined based on the Address)
-                    6. State (only if Country of Origin is India, determined from address; otherwise "non_stated")
-
-                    Rules:
-                    - If a parameter is not found, set its value to "non_stated".
-                    - if multiple values are found for a parameter, choose only one the most relevant one based on context.
-                    - Extract exact values; do not summarize or modify (e.g., do not state "SAME AS MARKETED BY").
-                    - Do not extract irrelevant metadata or nutritional values.
-                    - Do not extract a parameter multiple times.
-                    - For State, extract only if an Indian address is present; use address to infer the state if explicit state is missing.
-                    
-                    For each parameter, extract:
-                    - name: parameter name (e.g., manufacturer_name, net_quantity)
-                    - value: parameter value (e.g., ABC Corp, 500g)
-                    - context: category it belongs to (e.g., Manufacturing Details, Product Information, Consumer Care, Country of Origin)
-                    
-                    Return ONLY a JSON array of parameter objects with this structure:
-                    [
-                        {
-                            "name": string,
-                            "value": string,
-                            "context": string
-                        }
-                    ]
-                    Do not include any other text or explanation outside the JSON array."""
-                    
-                    prompt = (
-                        f"Extract compliance parameters from this text:\n"
-                        f"{ocr_text}\n\n"
-                        f"Return ONLY a valid JSON array of parameter objects."
-                    )
-                    
-                    response = await asyncio.to_thread(model.generate_content, [system_prompt, prompt])
-                    text = response.text.strip()
-                    logger.debug(f"Raw Gemini response: {text}")
-                    
-                    # Extract JSON array
-                    start = text.find('[')
-                    end = text.rfind(']') + 1
-                    if start >= 0 and end > start:
-                        json_text = text[start:end]
-                    else:
-                        raise ValueError("No JSON array found in response")
-                    
-                    parameters = json.loads(json_text)
-                    
-                    # Validate structure
-                    if not isinstance(parameters, list):
-                        raise ValueError("Response is not a JSON array")
-                    for param in parameters:
-                        if not isinstance(param, dict):
-                            raise ValueError("Parameter is not a JSON object")
-                        if not all(key in param for key in ["name", "value", "context"]):
-                            raise ValueError("Parameter missing required fields")
-                        if not all(isinstance(param[key], str) for key in ["name", "value", "context"]):
-                            raise ValueError("Parameter fields must be strings")
-                    
-                    logger.info(f"Extracted {len(parameters)} parameters for product {product.get('product_id')}")
-                    for param in parameters:
-                        logger.info(f"Parameter: {param['name']} = {param['value']} (Context: {param['context']})")
-                    
-                    product_info["compliance_parameters"] = parameters
-                    return product_info
+        for api_key_index, client in enumerate(clients):
+            try:
+                response = await client.aio.models.generate_content(
+                    model='gemini-2.0-flash',
+                    contents=[SYSTEM_PROMPT, prompt]
+                )
+                text = response.text.strip()
+                logger.debug(f"Raw Gemini response: {text}")
                 
-                except Exception as e:
-                    logger.error(f"Error with API key {api_key_index + 1} for product {product.get('product_id')}: {e}")
-                    if api_key_index < len(api_keys) - 1:
-                        logger.info(f"Retrying with next API key for product {product.get('product_id')}")
-                        continue
-                    else:
-                        logger.error(f"All API keys failed for product {product.get('product_id')}")
-                        product_info["compliance_parameters"] = [
-                            {"name": "manufacturer_name", "value": "non_stated", "context": "Manufacturing Details"},
-                            {"name": "manufacturer_address", "value": "non_stated", "context": "Manufacturing Details"},
-                            {"name": "net_quantity", "value": "non_stated", "context": "Product Information"},
-                            {"name": "consumer_care_address", "value": "non_stated", "context": "Consumer Care"},
-                            {"name": "consumer_care_phone", "value": "non_stated", "context": "Consumer Care"},
-                            {"name": "consumer_care_email", "value": "non_stated", "context": "Consumer Care"},
-                            {"name": "country_of_origin", "value": "non_stated", "context": "Country of Origin"},
-                            {"name": "state", "value": "non_stated", "context": "Country of Origin"}
-                        ]
-                        return product_info
+                # Extract JSON array
+                start = text.find('[')
+                end = text.rfind(']') + 1
+                if start >= 0 and end > start:
+                    json_text = text[start:end]
+                else:
+                    raise ValueError("No JSON array found in response")
+                
+                batch_parameters = orjson.loads(json_text)
+                if not isinstance(batch_parameters, list) or len(batch_parameters) != len(pending):
+                    raise ValueError(f"Expected a JSON array of {len(pending)} parameter arrays")
+            except Exception as e:
+                logger.error(f"Error with API key {api_key_index + 1} for {len(pending)} products: {e}")
+                if api_key_index < len(clients) - 1:
+                    logger.info("Retrying with next API key")
+                continue
+            
+            # Validate structure per product
+            results = []
+            for product, parameters in zip(pending, batch_parameters):
+                try:
+                    validate_parameters(parameters)
+                    results.append(parameters)
+                except ValueError as e:
+                    logger.warning(f"Invalid parameters for product {product.get('product_id')}: {e}")
+                    results.append(None)
+            return results
+        
+        return [None] * len(pending)
+    
+    async def process_batch(batch: List[Dict], parameter_cache: shelve.Shelf) -> List[Dict]:
+        pending = []
+        for product in batch:
+            logger.info(f"Processing product: {product.get('product_name', 'Unknown')}")
+            if not product.get("ocr_results"):
+                logger.warning(f"No OCR results for product {product.get('product_id')}")
+                product["compliance_parameters"] = non_stated_parameters()
+                continue
+            
+            cache_key = ocr_cache_key(" ".join(product["ocr_results"]))
+            if cache_key in parameter_cache:
+                logger.info(f"Using cached parameters for product {product.get('product_id')}")
+                product["compliance_parameters"] = parameter_cache[cache_key]
+            else:
+                pending.append((product, cache_key))
+        
+        if not pending:
+            return batch
+        
+        if not clients:
+            logger.error("No Gemini API keys configured")
+            for product, _ in pending:
+                product["compliance_parameters"] = non_stated_parameters()
+            return batch
+        
+        # Products whose entry in the batch reply was invalid are re-requested on their own,
+        # so one bad entry doesn't cost the rest of the batch
+        batch_parameters = await request_parameters([product for product, _ in pending])
+        retry = [index for index, parameters in enumerate(batch_parameters) if parameters is None]
+        if retry and len(pending) > 1:
+            logger.info(f"Re-requesting {len(retry)} of {len(pending)} products individually")
+            single_parameters = await asyncio.gather(*(request_parameters([pending[index][0]]) for index in retry))
+            for index, parameters in zip(retry, single_parameters):
+                batch_parameters[index] = parameters[0]
+        
+        for (product, cache_key), parameters in zip(pending, batch_parameters):
+            if parameters is None:
+                logger.error(f"No valid parameters from any API key for product {product.get('product_id')}")
+                product["compliance_parameters"] = non_stated_parameters()
+                continue
+            parameter_cache[cache_key] = parameters
+            logger.info(f"Extracted {len(parameters)} parameters for product {product.get('product_id')}")
+            for param in parameters:
+                logger.info(f"Parameter: {param['name']} = {param['value']} (Context: {param['context']})")
+            product["compliance_parameters"] = parameters
+        return batch
     
     try:
-        # Process products in batches to manage memory (16 GB RAM)
+        # Send products to Gemini in batches, one request per batch
         batch_size = 4
         result = []
-        for i in range(0, len(products), batch_size):
-            batch = products[i:i + batch_size]
-            logger.info(f"Processing batch {i // batch_size + 1} of {len(products) // batch_size + 1}")
-            tasks = [process_product(product) for product in batch]
-            result.extend(await asyncio.gather(*tasks, return_exceptions=True))
+        with shelve.open(PARAMETER_CACHE_FILE) as parameter_cache:
+            for i in range(0, len(products), batch_size):
+                batch = products[i:i + batch_size]
+                logger.info(f"Processing batch {i // batch_size + 1} of {len(products) // batch_size + 1}")
+                processed = await process_batch(batch, parameter_cache)
+                if output_queue is not None:
+                    for product in processed:
+                        await output_queue.put(product)
+                else:
+                    result.extend(processed)
         
         return result
     
@@ -161,20 +243,21 @@ async def main():
     """
     try:
         # Read structured compliance JSON
-        with open("structured_compliance_output_new.json", "r", encoding="utf-8") as f:
-            products = json.load(f)
+        with open("structured_compliance_output_new.json", "rb") as f:
+            products = orjson.loads(f.read())
         
         # Extract compliance parameters with two API keys
         api_keys = [
             os.getenv("GEMINI_API_KEY"),
             os.getenv("GEMINI_API_KEY_2")
         ]
-        extracted_data = await extract_compliance_parameters(products, api_keys)
+        # Stream each product to disk as its batch finishes
+        jsonl_file = "compliance_parameters_output_new.jsonl"
+        await stream_to_jsonl(lambda write_queue: extract_compliance_parameters(products, api_keys, output_queue=write_queue), jsonl_file)
         
-        # Save output JSON
+        # Merge into the JSON array read by the validation step
         output_file = "compliance_parameters_output_new.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(extracted_data, f, indent=4, ensure_ascii=False)
+        jsonl_to_json(jsonl_file, output_file)
         
         logger.info(f"✅ Parameter extraction complete. Output saved to {output_file}")
         
@@ -0,0 +1,86 @@
+import os
+import asyncio
+from typing import Optional, Dict, Callable, Awaitable
+
+import orjson
+
+async def write_jsonl(queue: asyncio.Queue, path: str, fsync_every: int = 16) -> int:
+    """
+    Single writer draining product records from a queue into a JSON Lines file.
+    
+    Records are written as soon as they arrive, so a crash loses at most the last
+    fsync_every records. Put None on the queue to stop the writer.
+    
+    Args:
+        queue: Queue of product dictionaries, terminated by None
+        path: Output .jsonl path (truncated at start)
+        fsync_every: Number of records between flushes to disk
+    Returns:
+        Number of records written
+    """
+    count = 0
+    with open(path, "wb") as f:
+        while True:
+            record: Optional[Dict] = await queue.get()
+            if record is None:
+                break
+            f.write(orjson.dumps(record) + b"\n")
+            count += 1
+            if count % fsync_every == 0:
+                f.flush()
+                os.fsync(f.fileno())
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+async def stream_to_jsonl(produce: Callable[[asyncio.Queue], Awaitable], path: str, maxsize: int = 64) -> int:
+    """
+    Run a producer that puts records on a bounded queue while write_jsonl writes them to path.
+    
+    A failing writer stops draining the queue, which would leave the producer blocked on a full
+    queue forever; instead the producer is cancelled and the writer's error is raised.
+    
+    Args:
+        produce: Called with the queue; returns the coroutine producing the records
+        path: Output .jsonl path (truncated at start)
+        maxsize: Maximum number of records waiting to be written
+    Returns:
+        Number of records written
+    Raises:
+        The producer's or the writer's exception
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+    writer = asyncio.create_task(write_jsonl(queue, path))
+    producer = asyncio.create_task(produce(queue))
+    try:
+        # The writer only returns after the None sentinel, so finishing first means it failed
+        await asyncio.wait({producer, writer}, return_when=asyncio.FIRST_COMPLETED)
+        if writer.done():
+            producer.cancel()
+            writer.result()
+        await producer
+    finally:
+        producer.cancel()
+        if not writer.done():
+            sentinel = asyncio.ensure_future(queue.put(None))
+            await asyncio.wait({sentinel, writer}, return_when=asyncio.FIRST_COMPLETED)
+            sentinel.cancel()
+        # Let the writer flush everything already queued before any error propagates
+        await asyncio.gather(writer, return_exceptions=True)
+    return writer.result()
+
+def jsonl_to_json(jsonl_path: str, json_path: str) -> int:
+    """
+    Merge a JSON Lines file into the JSON array format read by the next pipeline stage.
+    
+    Args:
+        jsonl_path: Input .jsonl path
+        json_path: Output .json path
+    Returns:
+        Number of records merged
+    """
+    with open(jsonl_path, "rb") as f:
+        records = [orjson.loads(line) for line in f if line.strip()]
+    with open(json_path, "wb") as f:
+        f.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
+    return len(records)
\ No newline at end of file
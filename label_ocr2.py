@@ -1,27 +1,119 @@
-import json
+import os
+import sys
+import orjson
+import shelve
 import asyncio
 import logging
-from typing import List, Dict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from rapidocr import RapidOCR
+from io import BytesIO
+from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from PIL import Image
+from dotenv import load_dotenv
+from rapidocr import RapidOCR, EngineType
+from jsonl_output import stream_to_jsonl, jsonl_to_json
+
+load_dotenv()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def perform_ocr(url: str, ocr_engine: RapidOCR) -> str:
+# OCR inference backend: "cpu" (default), "cuda" (needs onnxruntime-gpu) or "openvino"
+OCR_DEVICE = os.getenv("OCR_DEVICE", "cpu").lower()
+
+# Load RapidOCR once at import; ONNXRuntime parallelizes each inference across all cores itself
+OCR_PARAMS = {
+    "EngineConfig.onnxruntime.intra_op_num_threads": os.cpu_count() or -1,
+    "EngineConfig.onnxruntime.inter_op_num_threads": 1,
+}
+if OCR_DEVICE == "cuda":
+    OCR_PARAMS["EngineConfig.onnxruntime.use_cuda"] = True
+elif OCR_DEVICE == "openvino":
+    OCR_PARAMS.update({f"{stage}.engine_type": EngineType.OPENVINO for stage in ("Det", "Cls", "Rec")})
+
+# Optional overrides pointing at INT8 models produced by quantize_ocr_model
+if os.getenv("OCR_DET_MODEL_PATH"):
+    OCR_PARAMS["Det.model_path"] = os.getenv("OCR_DET_MODEL_PATH")
+if os.getenv("OCR_REC_MODEL_PATH"):
+    OCR_PARAMS["Rec.model_path"] = os.getenv("OCR_REC_MODEL_PATH")
+OCR_ENGINE = RapidOCR(params=OCR_PARAMS)
+
+# Largest side JPEGs are decoded at; libjpeg scales by 1/2, 1/4 or 1/8 during decoding, never below this
+OCR_DECODE_SIZE = (1600, 1600)
+
+# OCR text of every successfully OCR'd image, keyed by URL and kept across runs; failures are retried next run
+OCR_CACHE_FILE = "ocr_text_cache"
+
+# Concurrent image downloads feeding the OCR workers
+DOWNLOAD_WORKERS = 32
+
+# Bound on downloaded-but-not-yet-OCR'd images (and finished texts), capping memory at about this many images
+PIPELINE_QUEUE_SIZE = 64
+
+def quantize_ocr_model(model_path: str, output_path: str) -> str:
     """
-    Perform OCR on a single image URL using RapidOCR.
+    Quantize an FP32 RapidOCR ONNX model to 8-bit weights.
+    
+    Weights are quantized as unsigned 8-bit: the models are mostly convolutions, which dynamic
+    quantization turns into ConvInteger, and the CPU provider's kernel takes uint8 x uint8.
+    
+    Run as `python label_ocr2.py --quantize <fp32_model.onnx> <int8_model.onnx>`, then point
+    OCR_DET_MODEL_PATH / OCR_REC_MODEL_PATH at the output to use it. Keep the
+    FP32 recognition model if OCR accuracy drops on your labels.
     
     Args:
+        model_path: Path to the FP32 ONNX model
+        output_path: Path to write the INT8 model to
+    Returns:
+        The output path
+    """
+    from onnxruntime import InferenceSession
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QUInt8)
+    # Fail here rather than when OCR_ENGINE loads the model at import
+    InferenceSession(output_path, providers=["CPUExecutionProvider"])
+    logger.info(f"Quantized {model_path} -> {output_path}")
+    return output_path
+
+async def download_image(session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+    """
+    Download a single product image.
+    
+    Args:
+        session: Shared aiohttp session
         url: Image URL
-        ocr_engine: Initialized RapidOCR engine
     Returns:
-        Extracted text or empty string on failure
+        Image bytes or None on failure
+    """
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
+            response.raise_for_status()
+            return await response.read()
+    except Exception as e:
+        logger.error(f"Image download failed for {url}: {e}")
+        return None
+
+def perform_ocr(url: str, image: Optional[bytes]) -> Optional[str]:
+    """
+    Perform OCR on a single downloaded image using the shared RapidOCR engine.
+    
+    Args:
+        url: Image URL (used for logging)
+        image: Downloaded image bytes, or None if the download failed
+    Returns:
+        Extracted text (empty if the image has none), or None if the download or OCR failed
     """
+    if not image:
+        return None
     try:
-        # Perform OCR directly on URL
-        result = ocr_engine(url)
+        # Decode the prefetched bytes ourselves so large JPEGs are downscaled by libjpeg during
+        # decoding (draft is a no-op for other formats) instead of decoded at full resolution
+        decoded = Image.open(BytesIO(image))
+        decoded.draft("RGB", OCR_DECODE_SIZE)
+        decoded.load()
+        result = OCR_ENGINE(decoded)
         
         # Handle RapidOCROutput object
         total_text = ""
@@ -32,53 +124,96 @@ def perform_ocr(url: str, ocr_engine: RapidOCR) -> str:
         return total_text if total_text else ""
     except Exception as e:
         logger.error(f"OCR processing failed for {url}: {e}")
-        return ""
+        return None
 
-async def perform_ocr_on_images(products: List[Dict], max_workers: int = 10) -> List[Dict]:
+async def perform_ocr_on_images(products: List[Dict], max_workers: int = 2, output_queue: Optional[asyncio.Queue] = None) -> List[Dict]:
     """
-    Perform OCR on product images in parallel using threads.
+    Perform OCR on product images with a download -> OCR pipeline.
+    
+    Download workers feed a bounded queue drained by one OCR worker per thread, so network
+    waits and OCR inference overlap continuously instead of alternating batch by batch.
     
     Args:
         products: List of product dictionaries from amazon_products_with_all_images.json
-        max_workers: Number of parallel OCR workers (default: 8 for 16 GB RAM)
+        max_workers: Number of parallel OCR workers (default: 2, enough to overlap image decoding with inference)
+        output_queue: Optional queue receiving each product, in input order, as soon as all its images are done, instead of collecting them
     Returns:
-        List of product dictionaries with raw OCR text in ocr_results
+        List of product dictionaries with raw OCR text in ocr_results (empty when streaming to output_queue)
     """
-    # Initialize RapidOCR once
-    ocr_engine = RapidOCR()
     structured_data = []
+    loop = asyncio.get_running_loop()
     
-    # Process products in batches to manage memory
-    batch_size = 10  # Increased batch size for better throughput
-    for i in range(0, len(products), batch_size):
-        batch = products[i:i + batch_size]
-        logger.info(f"Processing batch {i // batch_size + 1} of {len(products) // batch_size + 1}")
-        
-        for product in batch:
-            product_info = {**product}  # Copy all existing keys
-            product_info["ocr_results"] = []
+    # One HTTP session and one worker pool shared by every product; images mostly come from the
+    # same CDN hosts, so DNS results are cached and connections kept alive
+    connector = aiohttp.TCPConnector(limit=64, ttl_dns_cache=300, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, shelve.open(OCR_CACHE_FILE) as text_cache:
+            # Each distinct image is downloaded and OCR'd once; images already in the text cache are skipped
+            urls = list(dict.fromkeys(url for product in products for url in product.get("all_images", []) if url not in text_cache))
+            logger.info(f"Running OCR on {len(urls)} uncached images for {len(products)} products")
+            
+            url_queue = asyncio.Queue()
+            for url in urls:
+                url_queue.put_nowait(url)
+            image_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            text_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            
+            async def download_worker() -> None:
+                while not url_queue.empty():
+                    url = url_queue.get_nowait()
+                    await image_queue.put((url, await download_image(session, url)))
             
-            # Collect all image URLs for this product
-            image_urls = product.get("all_images", [])
-            if not image_urls:
-                structured_data.append(product_info)
-                continue
+            async def ocr_worker() -> None:
+                while True:
+                    item = await image_queue.get()
+                    if item is None:
+                        return
+                    url, image = item
+                    text = await loop.run_in_executor(executor, perform_ocr, url, image)
+                    await text_queue.put((url, text))
             
-            logger.info(f"Processing {len(image_urls)} images for product: {product.get('product_name', 'Unknown')}")
+            async def run_downloads() -> None:
+                await asyncio.gather(*(download_worker() for _ in range(min(DOWNLOAD_WORKERS, len(urls)))))
+                for _ in range(max_workers):
+                    await image_queue.put(None)
             
-            # Parallel OCR processing with ThreadPoolExecutor
-            if image_urls:
-                with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    future_to_url = {
-                        executor.submit(perform_ocr, url, ocr_engine): url 
-                        for url in image_urls
-                    }
-                    for future in as_completed(future_to_url):
-                        text = future.result()
-                        if text:
-                            product_info["ocr_results"].append(text)
+            # Images still pending per product, and the products waiting on each image
+            pending_counts = [0] * len(products)
+            waiting_products = {}
+            for index, product in enumerate(products):
+                for url in dict.fromkeys(product.get("all_images", [])):
+                    if url not in text_cache:
+                        pending_counts[index] += 1
+                        waiting_products.setdefault(url, []).append(index)
             
-            structured_data.append(product_info)
+            pipeline = [asyncio.create_task(run_downloads())] + [asyncio.create_task(ocr_worker()) for _ in range(max_workers)]
+            try:
+                ocr_texts = {}
+                next_index = 0
+                for completed in range(len(urls) + 1):
+                    if completed:
+                        url, text = await text_queue.get()
+                        ocr_texts[url] = text or ""
+                        if text is not None:
+                            text_cache[url] = text
+                        for index in waiting_products[url]:
+                            pending_counts[index] -= 1
+                    
+                    # Annotate finished products in place, in input order; the input list is not reused
+                    while next_index < len(products) and pending_counts[next_index] == 0:
+                        product = products[next_index]
+                        product_texts = [ocr_texts[url] if url in ocr_texts else text_cache.get(url, "") for url in product.get("all_images", [])]
+                        product["ocr_results"] = [text for text in product_texts if text]
+                        if output_queue is not None:
+                            await output_queue.put(product)
+                        else:
+                            structured_data.append(product)
+                        next_index += 1
+                
+                await asyncio.gather(*pipeline)
+            finally:
+                for task in pipeline:
+                    task.cancel()
     
     return structured_data
 
@@ -88,16 +223,16 @@ async def main():
     """
     try:
         # Read product data
-        with open("amazon_products_with_all_images.json", "r", encoding="utf-8") as f:
-            products = json.load(f)
+        with open("amazon_products_with_all_images.json", "rb") as f:
+            products = orjson.loads(f.read())
         
-        # Perform OCR and store raw text
-        structured_data = await perform_ocr_on_images(products, max_workers=8)
+        # Perform OCR and stream each product's raw text to disk as soon as its images are done
+        jsonl_file = "structured_compliance_output_new.jsonl"
+        await stream_to_jsonl(lambda write_queue: perform_ocr_on_images(products, output_queue=write_queue), jsonl_file)
         
-        # Save output JSON
+        # Merge into the JSON array read by the parameter extraction step
         output_file = "structured_compliance_output_new.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(structured_data, f, indent=4, ensure_ascii=False)
+        jsonl_to_json(jsonl_file, output_file)
         
         logger.info(f"✅ OCR extraction complete. Output saved to {output_file}")
         
@@ -107,4 +242,10 @@ async def main():
         logger.error(f"Unexpected error: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # python label_ocr2.py --quantize <fp32_model.onnx> <int8_model.onnx>
+    if len(sys.argv) > 1 and sys.argv[1] == "--quantize":
+        if len(sys.argv) != 4:
+            sys.exit("Usage: python label_ocr2.py --quantize <fp32_model.onnx> <int8_model.onnx>")
+        quantize_ocr_model(sys.argv[2], sys.argv[3])
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -1,8 +1,13 @@
+import re
+import random
 import json
+import orjson
+import hashlib
 import logging
 import asyncio
-from typing import List, Dict
-import google.generativeai as genai
+from typing import List, Dict, Optional
+from google import genai
+from google.genai import types
 import os
 from dotenv import load_dotenv
 
@@ -12,8 +17,162 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Semaphore for Gemini API rate-limiting
-api_semaphore = asyncio.Semaphore(1)
+# Concurrent Gemini calls allowed per API key (rate-limiting)
+PER_KEY_CONCURRENCY = 2
+
+# Upper bound in seconds for the jittered exponential backoff on rate-limit errors
+MAX_BACKOFF = 30
+
+# raw_decode stops at the end of the first JSON value, so trailing fences or prose are never scanned
+JSON_DECODER = json.JSONDecoder()
+
+# Context reported for each validated parameter; also the parameter list used by the fallback paths
+PARAM_CONTEXT = {
+    "manufacturer_name": "Manufacturing Details",
+    "manufacturer_address": "Manufacturing Details",
+    "net_quantity": "Product Information",
+    "consumer_care_details": "Consumer Care",
+    "country_of_origin": "Country of Origin",
+    "state": "Country of Origin"
+}
+
+# Shape of a clearly well-formed value for each mandatory parameter, used by the local fast path
+MANDATORY_PATTERNS = {
+    "manufacturer_name": re.compile(r"[A-Za-z]{3}"),
+    "manufacturer_address": re.compile(r"\b\d{3}\s?\d{3}\b"),
+    "net_quantity": re.compile(r"\d+(?:\.\d+)?\s*(?:kg|g|mg|ml|l|ltr|litres?|liters?|pcs|pieces|units?|n)\b", re.IGNORECASE),
+    "consumer_care_details": re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+|\d[\d\s-]{8,}\d"),
+    "country_of_origin": re.compile(r"^\s*[A-Za-z][A-Za-z .&-]+\s*$")
+}
+STATE_PATTERN = re.compile(r"[A-Za-z][A-Za-z .&-]+")
+
+# Values meaning a parameter was not found, in compliance_parameters and scraped_results alike
+MISSING_VALUES = (None, "", "non_stated")
+
+# scraped_results fields accepted as a source for a parameter missing from compliance_parameters
+SCRAPED_SOURCES = {
+    "manufacturer_address": ("manufacturer_address", "packer_address"),
+    "net_quantity": ("item_weight",)
+}
+
+def retry_delay_seconds(error: Exception) -> float:
+    """
+    Read the retry delay the server suggested in a Gemini rate-limit error.
+    
+    Args:
+        error: Exception raised by the Gemini client
+    Returns:
+        Suggested delay in seconds, or 0 when the error carries none
+    """
+    details = getattr(error, "details", None)
+    if not isinstance(details, dict):
+        return 0.0
+    for detail in details.get("error", {}).get("details", []):
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("RetryInfo"):
+            try:
+                return float(str(detail.get("retryDelay", "0")).rstrip("s"))
+            except ValueError:
+                return 0.0
+    return 0.0
+
+def fast_validate(parameters: List[Dict], scraped_results: Dict) -> Optional[Dict]:
+    """
+    Validate a product locally when every mandatory parameter is clearly well-formed or clearly missing.
+    
+    Args:
+        parameters: Product's compliance_parameters
+        scraped_results: Product's scraped_results
+    Returns:
+        Result in the same shape as the Gemini response, or None when the product needs Gemini's judgment
+    """
+    stated = {}
+    for param in parameters:
+        if not isinstance(param, dict) or param.get("value") in MISSING_VALUES:
+            continue
+        if param.get("name") not in PARAM_CONTEXT:
+            return None  # e.g. split consumer_care_* fields
+        stated[param["name"]] = param["value"]
+    
+    validation_results = []
+    for name, pattern in MANDATORY_PATTERNS.items():
+        value = stated.get(name)
+        if value is None:
+            value = next((scraped_results[key] for key in SCRAPED_SOURCES.get(name, ()) if scraped_results.get(key) not in MISSING_VALUES), None)
+        if value is None:
+            validation_results.append({"name": name, "value": "non_stated", "context": PARAM_CONTEXT[name], "is_compliant": False, "violation": f"Missing mandatory parameter: {name}"})
+        elif isinstance(value, str) and pattern.search(value):
+            validation_results.append({"name": name, "value": value, "context": PARAM_CONTEXT[name], "is_compliant": True, "violation": ""})
+        else:
+            return None
+    
+    # Only all-compliant or all-missing products are unambiguous
+    compliant_count = sum(res["is_compliant"] for res in validation_results)
+    if 0 < compliant_count < len(validation_results):
+        return None
+    
+    state = stated.get("state")
+    if state is not None:
+        if not isinstance(state, str) or not STATE_PATTERN.fullmatch(state.strip()):
+            return None
+        validation_results.append({"name": "state", "value": state, "context": PARAM_CONTEXT["state"], "is_compliant": True, "violation": ""})
+    
+    flags = [res["violation"] for res in validation_results if not res["is_compliant"]]
+    return {
+        "validation_results": validation_results,
+        "policy_decision": "APPROVED" if not flags else "DENIED",
+        "reason": "fully compliant" if not flags else "; ".join(flags)
+    }
+
+# Static part of the validation prompt; only the input data appended after it changes per product
+PROMPT_PREFIX = """You are an expert in India's Legal Metrology (Packaged Commodities) Rules, 2011.
+
+Validate the following parameters, checking both compliance_parameters and scraped_results:
+- manufacturer_name (or packer/importer name)
+- manufacturer_address (or packer/importer address)
+- net_quantity (can be from 'item_weight' in scraped_results)
+- consumer_care_details will include address, phone, email (compliant if any one of them is available)
+- country_of_origin (non-strict; does not affect policy_decision if missing or invalid)
+- state (non-strict; does not affect policy_decision if missing or invalid)
+
+Rules:
+- A parameter is compliant if present and valid in either compliance_parameters or scraped_results.
+- If a parameter is missing in both, mark it as non-compliant with "Missing mandatory parameter".
+- For net_quantity, accept 'item_weight' from scraped_results as a valid source.
+- For state, validate if present and country_of_origin is India, but do not mark product as DENIED if state is missing or invalid.
+- Extract exact values without modification.
+- Do not divide parameters into multiple entries like consumer_care_details to address, phone, email.
+
+For each parameter, return:
+- name: Parameter name
+- value: Parameter value (from compliance_parameters or scraped_results, prefer compliance_parameters if both present)
+- context: Category
+- is_compliant: Boolean (true if present and valid in either source)
+- violation: Reason for non-compliance (empty if compliant)
+- If a parameter (except state and country_of_origin) is missing in both or invalid,
+  mark it as non-compliant with a specific violation reason (e.g., 'Missing manufacturer_name', 'Invalid consumer_care_details')
+
+Return a JSON object with:
+- validation_results: Array of validation objects
+- policy_decision: "APPROVED" if all mandatory parameters (except state) are compliant, else "DENIED"
+- reason: "fully compliant" if APPROVED, else list specific violations (exclude state violations)
+
+Structure:
+{
+    "validation_results": [
+        {
+            "name": string,
+            "value": string,
+            "context": string,
+            "is_compliant": boolean,
+            "violation": string
+        }
+    ],
+    "policy_decision": string,
+    "reason": string
+}
+Do not include any other text or explanation outside the JSON object.
+
+Input Data: """
 
 async def validate_compliance_parameters(products: List[Dict], api_keys: List[str], rules_file: str = "comply_summary.txt", max_retries: int = 3) -> List[Dict]:
     """
@@ -32,9 +191,99 @@ async def validate_compliance_parameters(products: List[Dict], api_keys: List[st
         with open(rules_file, 'r', encoding='utf-8') as f:
             rules_text = f.read().strip()
         
+        # One client and one semaphore per API key; the old google.generativeai configure() was
+        # process-global, so independent clients are what let calls on different keys run concurrently
+        api_keys = [api_key for api_key in api_keys if api_key]
+        clients = [genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=60_000)) for api_key in api_keys]
+        key_semaphores = [asyncio.Semaphore(PER_KEY_CONCURRENCY) for _ in api_keys]
+        in_flight = [0] * len(api_keys)
+        validation_memo = {}  # Gemini validation tasks keyed by a hash of the combined input
+        
+        def key_order() -> List[int]:
+            # Least-loaded key first; the others follow as fallbacks
+            return sorted(range(len(api_keys)), key=lambda index: in_flight[index])
+        
+        def api_error_result(product_info: Dict, error: str) -> Dict:
+            # DENIED result with every parameter marked as an API processing error
+            product_info["validation_results"] = [
+                {"name": param, "value": "non_stated", "context": context, "is_compliant": False, "violation": "API processing error"}
+                for param, context in PARAM_CONTEXT.items()
+            ]
+            product_info["policy_decision"] = "DENIED"
+            product_info["reason"] = f"API processing error: {error}"
+            product_info["report_id"] = f"report_{product_info.get('product_id', 'unknown')}_error"
+            return product_info
+        
+        async def validate_with_gemini(combined_input: Dict, product_id: str) -> Dict:
+            # Validate one input with Gemini, falling back across keys; raises the last error if every key fails
+            system_prompt = PROMPT_PREFIX + orjson.dumps(combined_input, option=orjson.OPT_INDENT_2).decode()
+            
+            for key_position, api_key_index in enumerate(key_order()):
+                for attempt in range(max_retries):
+                    try:
+                        in_flight[api_key_index] += 1
+                        try:
+                            async with key_semaphores[api_key_index]:
+                                response = await clients[api_key_index].aio.models.generate_content(
+                                    model='gemini-2.0-flash',
+                                    contents=[system_prompt]
+                                )
+                        finally:
+                            in_flight[api_key_index] -= 1
+                        text = response.text.strip()
+                        
+                        # Extract JSON object
+                        start = text.find('{')
+                        if start < 0:
+                            raise ValueError("No JSON object found in response")
+                        
+                        result, _ = JSON_DECODER.raw_decode(text, start)
+                        
+                        # Validate structure
+                        if not isinstance(result, dict) or "validation_results" not in result or "policy_decision" not in result or "reason" not in result:
+                            raise ValueError("Invalid response structure")
+                        for res in result["validation_results"]:
+                            if not all(key in res for key in ["name", "value", "context", "is_compliant", "violation"]):
+                                raise ValueError("Validation result missing required fields")
+                            if not isinstance(res["is_compliant"], bool) or not all(isinstance(res[key], str) for key in ["name", "value", "context", "violation"]):
+                                raise ValueError("Invalid validation result field types")
+                        
+                        # Check for missing mandatory parameters (state is non-strict)
+                        present_params = {res["name"] for res in result["validation_results"]}
+                        for param, context in PARAM_CONTEXT.items():
+                            if param != "state" and param not in present_params:
+                                result["validation_results"].append({
+                                    "name": param,
+                                    "value": "non_stated",
+                                    "context": context,
+                                    "is_compliant": False,
+                                    "violation": f"Missing mandatory parameter: {param}"
+                                })
+                        
+                        # Update policy_decision and reason, excluding state violations
+                        flags = [res["violation"] for res in result["validation_results"] if not res["is_compliant"] and res["violation"] and res["name"] != "state"]
+                        result["policy_decision"] = "APPROVED" if not flags else "DENIED"
+                        result["reason"] = "fully compliant" if not flags else "; ".join(flags)
+                        
+                        logger.info(f"Validated {len(result['validation_results'])} parameters for product {product_id}")
+                        return result
+                    
+                    except Exception as e:
+                        if "429" in str(e) and attempt < max_retries - 1:
+                            # Jittered exponential backoff so concurrent products don't retry in lockstep,
+                            # never shorter than the delay the server asked for
+                            wait_time = max(min(MAX_BACKOFF, 2 ** attempt + random.uniform(0, 1)), retry_delay_seconds(e))
+                            logger.warning(f"Rate limit hit for API key {api_key_index + 1} on product {product_id}. Retrying after {wait_time:.1f}s (attempt {attempt + 1}/{max_retries})")
+                            await asyncio.sleep(wait_time)
+                        elif key_position < len(clients) - 1:
+                            logger.info(f"Switching to next API key for product {product_id}")
+                            break
+                        else:
+                            raise
+        
         async def process_product(product: Dict) -> Dict:
             logger.info(f"Processing product: {product.get('product_name', 'Unknown')}")
-            product_info = {**product}  # Copy existing keys
+            product_info = product  # Annotate in place; the input list is not reused
             parameters = product.get("compliance_parameters", [])
             scraped_results = product.get("scraped_results", {})
             
@@ -47,162 +296,67 @@ async def validate_compliance_parameters(products: List[Dict], api_keys: List[st
                 product_info["report_id"] = f"report_{product.get('product_id', 'unknown')}_no_data"
                 return product_info
             
-            async with api_semaphore:
-                for api_key_index, api_key in enumerate(api_keys):
-                    for attempt in range(max_retries):
-                        try:
-                            genai.configure(api_key=api_key)
-                            model = genai.GenerativeModel('gemini-2.0-flash')
-                            
-                            # Combine compliance_parameters and scraped_results for validation
-                            combined_input = {
-                                "compliance_parameters": parameters,
-                                "scraped_results": scraped_results
-                            }
-                            
-                            system_prompt = f"""
-                            You are an expert in India's Legal Metrology (Packaged Commodities) Rules, 2011.
+            # blake2b over sorted keys keeps the suffix stable across runs, unlike the salted built-in hash()
+            report_digest = hashlib.blake2b(orjson.dumps(parameters, option=orjson.OPT_SORT_KEYS), digest_size=2).hexdigest()
+            report_id = f"report_{product.get('product_id', 'unknown')}_{report_digest}"
+            
+            # Combine compliance_parameters and scraped_results for validation
+            combined_input = {
+                "compliance_parameters": parameters,
+                "scraped_results": scraped_results
+            }
+            memo_key = hashlib.blake2b(orjson.dumps(combined_input, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+            
+            # Skip Gemini for unambiguous products
+            result = fast_validate(parameters, scraped_results)
+            if result is not None:
+                product_info.update(result)
+                product_info["report_id"] = report_id
+                logger.info(f"Validated product {product.get('product_id')} without a Gemini call")
+                return product_info
+            
+            if not clients:
+                logger.error(f"No Gemini API keys configured for product {product.get('product_id')}")
+                return api_error_result(product_info, "No Gemini API keys configured")
+            
+            # Identical inputs share one Gemini call, including a call that is still in flight
+            gemini_task = validation_memo.get(memo_key)
+            if gemini_task is None:
+                gemini_task = asyncio.ensure_future(validate_with_gemini(combined_input, product.get('product_id')))
+                validation_memo[memo_key] = gemini_task
+            else:
+                logger.info(f"Sharing the Gemini validation of an identical input with product {product.get('product_id')}")
+            try:
+                result = await gemini_task
+            except Exception as e:
+                # Let later duplicates retry instead of inheriting the failure
+                if validation_memo.get(memo_key) is gemini_task:
+                    del validation_memo[memo_key]
+                logger.error(f"All API keys failed for product {product.get('product_id')}: {e}")
+                return api_error_result(product_info, str(e))
+            
+            product_info.update(result)
+            product_info["report_id"] = report_id
+            return product_info
         
-                            Input Data: {json.dumps(combined_input, indent=2)}
-                            
-                            Validate the following parameters, checking both compliance_parameters and scraped_results:
-                            - manufacturer_name (or packer/importer name)
-                            - manufacturer_address (or packer/importer address)
-                            - net_quantity (can be from 'item_weight' in scraped_results)
-                            - consumer_care_details will include address, phone, email (compliant if any one of them is available)
-                            - country_of_origin (non-strict; does not affect policy_decision if missing or invalid)
-                            - state (non-strict; does not affect policy_decision if missing or invalid)
-                            
-                            Rules:
-                            - A parameter is compliant if present and valid in either compliance_parameters or scraped_results.
-                            - If a parameter is missing in both, mark it as non-compliant with "Missing mandatory parameter".
-                            - For net_quantity, accept 'item_weight' from scraped_results as a valid source.
-                            - For state, validate if present and country_of_origin is India, but do not mark product as DENIED if state is missing or invalid.
-                            - Extract exact values without modification.
-                            - Do not divide parameters into multiple entries like consumer_care_details to address, phone, email.
-                            
-                            For each parameter, return:
-                            - name: Parameter name
-                            - value: Parameter value (from compliance_parameters or scraped_results, prefer compliance_parameters if both present)
-                            - context: Category
-                            - is_compliant: Boolean (true if present and valid in either source)
-                            - violation: Reason for non-compliance (empty if compliant)
-                            - If a parameter (except state and country_of_origin) is missing in both or invalid, 
-                              mark it as non-compliant with a specific violation reason (e.g., 'Missing manufacturer_name', 'Invalid consumer_care_details')
-                            
-                            Return a JSON object with:
-                            - validation_results: Array of validation objects
-                            - policy_decision: "APPROVED" if all mandatory parameters (except state) are compliant, else "DENIED"
-                            - reason: "fully compliant" if APPROVED, else list specific violations (exclude state violations)
-                            
-                            Structure:
-                            {{
-                                "validation_results": [
-                                    {{
-                                        "name": string,
-                                        "value": string,
-                                        "context": string,
-                                        "is_compliant": boolean,
-                                        "violation": string
-                                    }}
-                                ],
-                                "policy_decision": string,
-                                "reason": string
-                            }}
-                            Do not include any other text or explanation outside the JSON object.
-                            """
-                            
-                            response = await asyncio.to_thread(model.generate_content, [system_prompt])
-                            text = response.text.strip()
-                            
-                            # Extract JSON object
-                            start = text.find('{')
-                            end = text.rfind('}') + 1
-                            if start < 0 or end <= start:
-                                raise ValueError("No JSON object found in response")
-                            
-                            result = json.loads(text[start:end])
-                            
-                            # Validate structure
-                            if not isinstance(result, dict) or "validation_results" not in result or "policy_decision" not in result or "reason" not in result:
-                                raise ValueError("Invalid response structure")
-                            for res in result["validation_results"]:
-                                if not all(key in res for key in ["name", "value", "context", "is_compliant", "violation"]):
-                                    raise ValueError("Validation result missing required fields")
-                                if not isinstance(res["is_compliant"], bool) or not all(isinstance(res[key], str) for key in ["name", "value", "context", "violation"]):
-                                    raise ValueError("Invalid validation result field types")
-                            
-                            # Check for missing mandatory parameters
-                            # Check for missing mandatory parameters
-                            mandatory_params = [
-                                "manufacturer_name",
-                                "manufacturer_address",
-                                "net_quantity",
-                                "consumer_care_details",   
-                                "country_of_origin"
-                            ]
-                            present_params = {res["name"] for res in result["validation_results"]}
-                            for param in mandatory_params:
-                                if param not in present_params:
-                                    result["validation_results"].append({
-                                        "name": param,
-                                        "value": "non_stated",
-                                        "context": "Manufacturing Details" if param in ["manufacturer_name", "manufacturer_address"] 
-                                                else "Product Information" if param == "net_quantity" 
-                                                else "Consumer Care" if param == "consumer_care_details" 
-                                                else "Country of Origin",
-                                        "is_compliant": False,
-                                        "violation": f"Missing mandatory parameter: {param}"
-                                    })
-
-                            
-                            # Update policy_decision and reason, excluding state violations
-                            flags = [res["violation"] for res in result["validation_results"] if not res["is_compliant"] and res["violation"] and res["name"] != "state"]
-                            result["policy_decision"] = "APPROVED" if not flags else "DENIED"
-                            result["reason"] = "fully compliant" if not flags else "; ".join(flags)
-                            result["report_id"] = f"report_{product.get('product_id', 'unknown')}_{hash(json.dumps(parameters)) % 10000}"
-                            
-                            product_info.update(result)
-                            
-                            logger.info(f"Validated {len(result['validation_results'])} parameters for product {product.get('product_id')}")
-                            return product_info
-                        
-                        except Exception as e:
-                            if "429" in str(e) and attempt < max_retries - 1:
-                                wait_time = (2 ** attempt) * 1  # Exponential backoff
-                                logger.warning(f"Rate limit hit for API key {api_key_index + 1} on product {product.get('product_id')}. Retrying after {wait_time}s (attempt {attempt + 1}/{max_retries})")
-                                await asyncio.sleep(wait_time)
-                            elif api_key_index < len(api_keys) - 1:
-                                logger.info(f"Switching to next API key for product {product.get('product_id')}")
-                                break
-                            else:
-                                logger.error(f"All API keys failed for product {product.get('product_id')}: {e}")
-                                mandatory_params = [
-                                    "manufacturer_name",
-                                    "manufacturer_address",
-                                    "net_quantity",
-                                    "consumer_care_address",
-                                    "consumer_care_phone",
-                                    "consumer_care_email",
-                                    "country_of_origin",
-                                    "state"
-                                ]
-                                product_info["validation_results"] = [
-                                    {"name": param, "value": "non_stated", "context": "Manufacturing Details" if param in ["manufacturer_name", "manufacturer_address"] else "Product Information" if param == "net_quantity" else "Consumer Care" if param in ["consumer_care_address", "consumer_care_phone", "consumer_care_email"] else "Country of Origin", "is_compliant": False, "violation": "API processing error"} for param in mandatory_params
-                                ]
-                                product_info["policy_decision"] = "DENIED"
-                                product_info["reason"] = f"API processing error: {str(e)}"
-                                product_info["report_id"] = f"report_{product.get('product_id', 'unknown')}_error"
-                                return product_info
+        # Worker pool sized to the total per-key concurrency; each worker pulls the next product as soon
+        # as its previous call finishes, so there is no barrier waiting on the slowest product of a batch
+        queue = asyncio.Queue()
+        for index, product in enumerate(products):
+            queue.put_nowait((index, product))
+        result = [None] * len(products)
+        
+        async def worker() -> None:
+            while not queue.empty():
+                index, product = queue.get_nowait()
+                try:
+                    result[index] = await process_product(product)
+                except Exception as e:
+                    result[index] = e
         
-        # Process products in batches to manage memory
-        batch_size = 3
-        result = []
-        for i in range(0, len(products), batch_size):
-            batch = products[i:i + batch_size]
-            logger.info(f"Processing batch {i // batch_size + 1} of {len(products) // batch_size + 1}")
-            tasks = [process_product(product) for product in batch]
-            result.extend(await asyncio.gather(*tasks, return_exceptions=True))
+        worker_count = max(1, min(PER_KEY_CONCURRENCY * len(api_keys), len(products)))
+        logger.info(f"Validating {len(products)} products with {worker_count} workers")
+        await asyncio.gather(*(worker() for _ in range(worker_count)))
         
         return result
     
@@ -219,8 +373,8 @@ async def main():
     """
     try:
         # Read input JSON
-        with open("compliance_parameters_output_new.json", "r", encoding="utf-8") as f:
-            products = json.load(f)
+        with open("compliance_parameters_output_new.json", "rb") as f:
+            products = orjson.loads(f.read())
         
         # Validate compliance parameters with two API keys
         api_keys = [
@@ -231,8 +385,8 @@ async def main():
         
         # Save output JSON
         output_file = "compliance_validation_output.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(validated_data, f, indent=4, ensure_ascii=False)
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(validated_data, option=orjson.OPT_INDENT_2))
         
         logger.info(f"✅ Validation complete. Output saved to {output_file}")
     